@@ -1,8 +1,13 @@
 import streamlit as st
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import base64
-import json
+import orjson
+import time
+from collections import deque
 import traceback
 import logging
 import google.oauth2.id_token
@@ -13,11 +18,48 @@ import google.auth.transport.requests
 # The backend URL will be injected as an environment variable in Cloud Run
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000")
 AUDIENCE = os.environ.get("AUDIENCE", "")
-API_URL = f"{BACKEND_URL}/api/noauth"
+API_URL = f"{BACKEND_URL}/api/noauth/stream"
 
 logging.basicConfig(level=logging.INFO)
 
 
+# --- HTTP Clients ---
+@st.cache_resource
+def get_http_session():
+    """
+    Returns a process-wide requests.Session with a tuned connection pool.
+
+    google.auth's transport requires a requests-compatible session, so this
+    is kept for ID token fetches; backend calls go through the httpx client
+    below.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=100,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource
+def get_backend_client():
+    """
+    Returns a process-wide httpx client for backend calls.
+
+    Streamlit reruns this script on every interaction, so the client is
+    cached as a resource and its pooled HTTP/2 connection multiplexes all
+    sessions in the process. Tight connect/read timeouts surface a slow
+    backend as an error instead of a hung script-runner thread.
+    """
+    return httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(5.0, connect=2.0, read=60.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+
 # --- IAP Header Extraction ---
 def get_iap_jwt():
     """
@@ -34,26 +76,63 @@ def get_iap_jwt():
         # This will fail when running locally or if headers are not available
         return None
 
+def _jwt_expiry(token):
+    """Extracts the exp claim from a JWT payload without verifying it."""
+    try:
+        _, payload, _ = token.split('.')
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except Exception:
+        # If the claim can't be read, assume a short lifetime
+        return time.time() + 300
+
 def get_backend_iap_jwt():
     """
-    Retrieves the IAP JWT from the request headers and generates a new
-    token for the backend.
+    Returns an ID token for calling the backend.
+
+    Streamlit reruns this script on every interaction, so the token is
+    cached in session state and reused until roughly a minute before its
+    exp claim; only then is the metadata server asked for a fresh one.
     """
+    cached = st.session_state.get("_backend_jwt")
+    if cached and time.time() < cached[1] - 60:
+        return cached[0]
+
     try:
         logging.info(f"Attempting to fetch token for audience: {AUDIENCE}")
-        auth_req = google.auth.transport.requests.Request()
+        # Reuse the pooled session so parallel refreshes don't exhaust the
+        # transport's connection pool.
+        auth_req = google.auth.transport.requests.Request(session=get_http_session())
         id_token = google.oauth2.id_token.fetch_id_token(auth_req, AUDIENCE)
-        
+
         if not id_token:
             logging.error("fetch_id_token returned a None or empty value.")
         else:
             logging.info("Successfully fetched ID token.")
-            
+            st.session_state["_backend_jwt"] = (id_token, _jwt_expiry(id_token))
+
         return id_token
     except Exception as e:
         logging.error(f"An exception occurred while trying to fetch the ID token: {e}", exc_info=True)
         return None
 
+def stream_reply_chunks(response):
+    """
+    Yields reply text chunks from the backend's SSE stream.
+
+    The final event carries the conversation ID, which is stored in session
+    state for the next turn.
+    """
+    for line in response.iter_lines():
+        if not line.startswith("data: "):
+            continue
+        event = orjson.loads(line[len("data: "):])
+        if event.get("done"):
+            st.session_state.conversation_id = event.get("conversation_id")
+            logging.info(f"Updated conversation ID to: {st.session_state.conversation_id}")
+        elif "chunk" in event:
+            yield event["chunk"]
+
 def display_jwt_info(iap_jwt):
     """Decodes and displays the contents of the IAP JWT for debugging."""
     if iap_jwt:
@@ -67,11 +146,11 @@ def display_jwt_info(iap_jwt):
                 # JWTs are composed of three parts, separated by dots.
                 # The middle part is the payload.
                 _, payload, _ = iap_jwt.split('.')
-                
-                # The payload is Base64Url-encoded. We need to add padding
-                # and decode it.
-                decoded_payload = base64.urlsafe_b64decode(payload + '==')
-                jwt_claims = json.loads(decoded_payload)
+
+                # The payload is Base64Url-encoded. We need to pad it to a
+                # multiple of four and decode it.
+                decoded_payload = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+                jwt_claims = orjson.loads(decoded_payload)
                 
                 st.json(jwt_claims)
                 st.caption("This is the decoded payload of the JWT. It contains user information and token details.")
@@ -83,11 +162,15 @@ def display_jwt_info(iap_jwt):
 st.title("️🤖 Secure AI Agent")
 st.caption("Powered by Vertex AI Search and secured with IAP")
 
-# Initialize chat history and conversation ID in session state
+# Initialize chat history and conversation ID in session state. History is a
+# bounded deque: Streamlit re-renders every message on each rerun, so capping
+# the display list keeps long sessions cheap. The backend conversation_id
+# still carries full server-side context, so truncation loses nothing.
 if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role": "assistant", "content": "Hello! How can I help you today?"}
-    ]
+    st.session_state.messages = deque(
+        [{"role": "assistant", "content": "Hello! How can I help you today?"}],
+        maxlen=int(os.environ.get("CHAT_HISTORY_MAX", "40")),
+    )
 if "conversation_id" not in st.session_state:
     st.session_state.conversation_id = None
 
@@ -113,43 +196,38 @@ if prompt := st.chat_input("Ask a question..."):
     if not iap_jwt:
         st.warning("This app is running in local mode. Backend calls are disabled.")
         response_text = "I am in local mode. I cannot connect to the backend."
+        with st.chat_message("assistant"):
+            st.markdown(response_text)
     else:
         headers = {"Authorization": f"Bearer {iap_jwt}"}
         payload = {
             "query": prompt,
             "conversation_id": st.session_state.conversation_id
         }
-        
+
         logging.info(f"Sending request to backend API at {API_URL}")
         logging.debug(f"Request payload: {payload}") # Use debug for more verbose info
 
-        with st.spinner("Thinking..."):
+        # Stream the reply into the chat container as chunks arrive instead
+        # of buffering behind a spinner.
+        with st.chat_message("assistant"):
             try:
-                response = requests.post(API_URL, headers=headers, json=payload)
-                response.raise_for_status()  # Raise an exception for bad status codes
-                
-                response_data = response.json()
-                response_text = response_data.get("reply", "No reply found.")
-                
-                logging.info(f"Successfully received response from backend. Status: {response.status_code}")
-                logging.debug(f"Response JSON: {response_data}")
+                with get_backend_client().stream("POST", API_URL, headers=headers, json=payload) as response:
+                    response.raise_for_status()  # Raise an exception for bad status codes
+                    response_text = str(st.write_stream(stream_reply_chunks(response)))
 
-                # Update the conversation ID for the next turn
-                st.session_state.conversation_id = response_data.get("conversation_id")
-                logging.info(f"Updated conversation ID to: {st.session_state.conversation_id}")
+                logging.info(f"Successfully received response from backend. Status: {response.status_code}")
 
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 # Log the exception with stack trace before showing it in the UI
                 logging.error("An exception occurred while connecting to the backend.", exc_info=True)
-                
+
                 # Now displays the full stack trace in an expander
                 st.error(f"Error connecting to backend: {e}")
                 with st.expander("View Full Error Trace"):
                     st.code(traceback.format_exc())
                 response_text = "An error occurred. Please check the details above."
+                st.markdown(response_text)
 
-    # Display assistant response in chat message container
-    with st.chat_message("assistant"):
-        st.markdown(response_text)
     # Add assistant response to chat history
     st.session_state.messages.append({"role": "assistant", "content": response_text})
\ No newline at end of file